@@ -1,17 +1,108 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+from chainer.backends import cuda
 import numpy as np
 from tqdm import tqdm
 
 from lib import spec_utils
 
 
+def _empty_pinned(shape, dtype=np.float32):
+    if cuda.available:
+        size = int(np.prod(shape))
+        mem = cuda.cupy.cuda.alloc_pinned_memory(
+            size * np.dtype(dtype).itemsize)
+        return np.frombuffer(mem, dtype, size).reshape(shape)
+    else:
+        return np.empty(shape, dtype=dtype)
+
+
+def batch_generator(X, y, bs, xp):
+    if xp is np:
+        for i in range(0, len(X), bs):
+            yield (i,
+                   X[i: i + bs].astype(np.float32, copy=False),
+                   y[i: i + bs].astype(np.float32, copy=False))
+        return
+
+    cupy = cuda.cupy
+    copy_stream = cupy.cuda.Stream(non_blocking=True)
+    compute_stream = cupy.cuda.get_current_stream()
+
+    def alloc_pinned(shape, dtype):
+        size = int(np.prod(shape))
+        mem = cupy.cuda.alloc_pinned_memory(size * np.dtype(dtype).itemsize)
+        return np.frombuffer(mem, dtype, size).reshape(shape)
+
+    # two sets of fixed-size staging/device buffers, reused for the whole epoch
+    buf_shape = (bs,) + X.shape[1:]
+    X_host = [alloc_pinned(buf_shape, X.dtype) for _ in range(2)]
+    y_host = [alloc_pinned(buf_shape, y.dtype) for _ in range(2)]
+    X_dev = [cupy.empty(buf_shape, X.dtype) for _ in range(2)]
+    y_dev = [cupy.empty(buf_shape, y.dtype) for _ in range(2)]
+    # half precision only rides the bus; compute sees float32
+    if X.dtype == np.float32:
+        X_f32, y_f32 = X_dev, y_dev
+    else:
+        X_f32 = [cupy.empty(buf_shape, np.float32) for _ in range(2)]
+        y_f32 = [cupy.empty(buf_shape, np.float32) for _ in range(2)]
+    done = [None, None]
+
+    def upload(i, p):
+        if done[p] is not None:
+            # the consumer must be finished with this buffer pair
+            done[p].synchronize()
+        n = min(bs, len(X) - i)
+        X_host[p][:n] = X[i: i + n]
+        y_host[p][:n] = y[i: i + n]
+        X_dev[p][:n].set(X_host[p][:n], stream=copy_stream)
+        y_dev[p][:n].set(y_host[p][:n], stream=copy_stream)
+        if X_f32 is not X_dev:
+            with copy_stream:
+                cupy.copyto(X_f32[p][:n], X_dev[p][:n])
+                cupy.copyto(y_f32[p][:n], y_dev[p][:n])
+        return X_f32[p][:n], y_f32[p][:n], copy_stream.record()
+
+    p = 0
+    item = upload(0, p)
+    for i in range(0, len(X), bs):
+        X_gpu, y_gpu, event = item
+        if i + bs < len(X):
+            item = upload(i + bs, 1 - p)
+        compute_stream.wait_event(event)
+        yield i, X_gpu, y_gpu
+        done[p] = compute_stream.record()
+        p = 1 - p
+
+
+def _load_pairs(filelist, sr, hop_length, mmap=False):
+    # decode/stft the next few pairs on worker threads while the main
+    # thread extracts patches, keeping at most 2x workers in flight
+    workers = min(len(filelist), os.cpu_count() or 1, 8)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        queue = deque()
+        filelist = iter(filelist)
+        for pair in filelist:
+            queue.append(executor.submit(
+                spec_utils.cache_or_load, pair[0], pair[1], sr, hop_length,
+                mmap))
+            if len(queue) >= workers * 2:
+                yield queue.popleft().result()
+        while len(queue) > 0:
+            yield queue.popleft().result()
+
+
 def mixup_generator(X, y, alpha):
     perm = np.random.permutation(len(X))[:len(X) // 2]
     if len(perm) % 2 != 0:
         perm = perm[:-1]
-    for i in range(0, len(perm), 2):
-        lam = np.random.beta(alpha, alpha)
-        X[perm[i]] = lam * X[perm[i]] + (1 - lam) * X[perm[i + 1]]
-        y[perm[i]] = lam * y[perm[i]] + (1 - lam) * y[perm[i + 1]]
+    a, b = perm[0::2], perm[1::2]
+    lam = np.random.beta(
+        alpha, alpha, size=(len(a), 1, 1, 1)).astype(X.dtype)
+    X[a] = lam * X[a] + (1 - lam) * X[b]
+    y[a] = lam * y[a] + (1 - lam) * y[b]
 
     return X, y
 
@@ -28,17 +119,19 @@ def get_oracle_data(X, y, instance_loss, oracle_rate, oracle_drop_rate):
 
 def make_training_set(filelist, cropsize, patches, sr, hop_length):
     len_dataset = patches * len(filelist)
-    X_dataset = np.zeros(
-        (len_dataset, 2, hop_length, cropsize), dtype=np.float32)
-    y_dataset = np.zeros(
-        (len_dataset, 2, hop_length, cropsize), dtype=np.float32)
-    for i, (X_path, y_path) in enumerate(tqdm(filelist)):
-        X, y = spec_utils.cache_or_load(X_path, y_path, sr, hop_length)
+    # one block for both roles: a single pinned registration, and pair i's
+    # mixture and instrumental planes stay a fixed stride apart
+    pair_dataset = _empty_pinned(
+        (2, len_dataset, 2, hop_length, cropsize), dtype=np.float16)
+    X_dataset = pair_dataset[0]
+    y_dataset = pair_dataset[1]
+    pairs = _load_pairs(filelist, sr, hop_length, mmap=True)
+    for i, (X, y, coeff) in enumerate(tqdm(pairs, total=len(filelist))):
         for j in range(patches):
             idx = i * patches + j
             start = np.random.randint(0, X.shape[2] - cropsize)
-            X_dataset[idx] = X[:, :, start:start + cropsize]
-            y_dataset[idx] = y[:, :, start:start + cropsize]
+            X_dataset[idx] = X[:, :, start:start + cropsize] / coeff
+            y_dataset[idx] = y[:, :, start:start + cropsize] / coeff
             if np.random.uniform() < 0.5:
                 # swap channel
                 X_dataset[idx] = X_dataset[idx, ::-1]
@@ -50,8 +143,10 @@ def make_training_set(filelist, cropsize, patches, sr, hop_length):
 def make_validation_set(filelist, cropsize, offset, sr, hop_length):
     X_dataset = []
     y_dataset = []
-    for i, (X_path, y_path) in enumerate(tqdm(filelist)):
-        X, y = spec_utils.cache_or_load(X_path, y_path, sr, hop_length)
+    pairs = _load_pairs(filelist, sr, hop_length)
+    for i, (X, y, coeff) in enumerate(tqdm(pairs, total=len(filelist))):
+        X = X / coeff
+        y = y / coeff
         left = offset
         roi_size = cropsize - offset * 2
         right = roi_size - (X.shape[2] % roi_size) + offset
@@ -63,4 +158,11 @@ def make_validation_set(filelist, cropsize, offset, sr, hop_length):
             X_dataset.append(X_pad[:, :, start:start + cropsize])
             y_dataset.append(y_pad[:, :, start:start + cropsize])
 
-    return np.float32(X_dataset), np.float32(y_dataset)
+    X_out = _empty_pinned(
+        (len(X_dataset),) + X_dataset[0].shape, dtype=np.float16)
+    y_out = _empty_pinned(
+        (len(y_dataset),) + y_dataset[0].shape, dtype=np.float16)
+    np.stack(X_dataset, out=X_out)
+    np.stack(y_dataset, out=y_out)
+
+    return X_out, y_out
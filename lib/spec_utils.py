@@ -1,10 +1,51 @@
 import os
 
+import chainer
+from chainer.backends import cuda
 import chainer.functions as F
 import librosa
 import numpy as np
 
 
+if cuda.available:
+    @cuda.cupy.fuse()
+    def _fused_masked_l1(x, mask, y):
+        return abs(x * mask - y)
+
+
+class MaskedL1(chainer.function_node.FunctionNode):
+
+    def forward_cpu(self, inputs):
+        self.retain_inputs((0, 1, 2))
+        x, mask, y = inputs
+        return np.abs(x * mask - y),
+
+    def forward_gpu(self, inputs):
+        self.retain_inputs((0, 1, 2))
+        x, mask, y = inputs
+        return _fused_masked_l1(x, mask, y),
+
+    def backward(self, indexes, grad_outputs):
+        x, mask, y = self.get_retained_inputs()
+        g, = grad_outputs
+        g = g * F.sign(x * mask - y)
+
+        grads = []
+        for i in indexes:
+            if i == 0:
+                grads.append(g * mask)
+            elif i == 1:
+                grads.append(g * x)
+            else:
+                grads.append(-g)
+
+        return tuple(grads)
+
+
+def masked_l1(x, mask, y):
+    return MaskedL1().apply((x, mask, y))[0]
+
+
 def crop_and_concat(h1, h2, concat=True):
     # s_freq = (h2.shape[2] - h1.shape[2]) // 2
     # e_freq = s_freq + h1.shape[2]
@@ -81,15 +122,16 @@ def align_wave_head_and_tail(a, b, sr):
     return a, b
 
 
-def cache_or_load(mix_path, inst_path, sr, hop_length):
+def cache_or_load(mix_path, inst_path, sr, hop_length, mmap=False):
     _, mix_ext = os.path.splitext(mix_path)
     _, inst_ext = os.path.splitext(inst_path)
     spec_mix_path = mix_path.replace(mix_ext, '.npy')
     spec_inst_path = inst_path.replace(inst_ext, '.npy')
 
     if os.path.exists(spec_mix_path) and os.path.exists(spec_inst_path):
-        X = np.load(spec_mix_path)
-        y = np.load(spec_inst_path)
+        mmap_mode = 'r' if mmap else None
+        X = np.load(spec_mix_path, mmap_mode=mmap_mode)
+        y = np.load(spec_inst_path, mmap_mode=mmap_mode)
     else:
         X, _ = librosa.load(
             mix_path, sr, False, dtype=np.float32, res_type='kaiser_fast')
@@ -107,7 +149,7 @@ def cache_or_load(mix_path, inst_path, sr, hop_length):
         np.save(spec_inst_path, y)
 
     coeff = np.max([X.max(), y.max()])
-    return X / coeff, y / coeff
+    return X, y, coeff
 
 
 def spec_to_wav(mag, phase, hop_length):
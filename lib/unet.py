@@ -117,6 +117,9 @@ class BaseUNet(chainer.Chain):
             self.dec2 = Decoder(None, ch * 2, 3, 1, pad)
             self.dec1 = Decoder(None, ch, 3, 1, pad)
 
+    # the per-band graphs are static, so trace them once and replay the
+    # cached schedule instead of re-dispatching every function per step
+    @chainer.static_graph
     def __call__(self, x):
         h, e1 = self.enc1(x)
         h, e2 = self.enc2(h)
@@ -7,6 +7,7 @@ import random
 
 import chainer
 import chainer.functions as F
+import chainer.links as L
 import numpy as np
 
 from lib import dataset
@@ -15,15 +16,13 @@ from lib import unet
 
 
 def train_val_split(mix_dir, inst_dir, val_rate, val_filelist_json):
-    input_exts = ['.wav', '.m4a', '.3gp', '.oma', '.mp3', '.mp4']
-    X_list = sorted([
-        os.path.join(mix_dir, fname)
-        for fname in os.listdir(mix_dir)
-        if os.path.splitext(fname)[1] in input_exts])
-    y_list = sorted([
-        os.path.join(inst_dir, fname)
-        for fname in os.listdir(inst_dir)
-        if os.path.splitext(fname)[1] in input_exts])
+    input_exts = frozenset(['wav', 'm4a', '3gp', 'oma', 'mp3', 'mp4'])
+    X_list = sorted(
+        entry.path for entry in os.scandir(mix_dir)
+        if entry.name.rpartition('.')[2].lower() in input_exts)
+    y_list = sorted(
+        entry.path for entry in os.scandir(inst_dir)
+        if entry.name.rpartition('.')[2].lower() in input_exts)
 
     filelist = list(zip(X_list, y_list))
     random.shuffle(filelist)
@@ -38,55 +37,55 @@ def train_val_split(mix_dir, inst_dir, val_rate, val_filelist_json):
         train_filelist = filelist[:-val_size]
         val_filelist = filelist[-val_size:]
     else:
+        val_set = set(map(tuple, val_filelist))
         train_filelist = [
             pair for pair in filelist
-            if list(pair) not in val_filelist]
+            if pair not in val_set]
 
     return train_filelist, val_filelist
 
 
 def train_inner_epoch(X_train, y_train, model, optimizer, bs, instance_loss):
-    sum_loss = 0
     xp = model.xp
+    sum_loss = xp.zeros((), dtype=np.float32)
     perm = np.random.permutation(len(X_train))
-    for i in range(0, len(X_train), bs):
+    X_shuf = np.take(X_train, perm, axis=0)
+    y_shuf = np.take(y_train, perm, axis=0)
+    instance_loss_acc = xp.zeros(len(X_train), dtype=np.float32)
+    for i, X_batch, y_batch in dataset.batch_generator(X_shuf, y_shuf, bs, xp):
         local_perm = perm[i: i + bs]
-        X_batch = xp.asarray(X_train[local_perm])
-        y_batch = xp.asarray(y_train[local_perm])
 
         model.cleargrads()
         mask = model(X_batch)
         X_batch = spec_utils.crop_and_concat(mask, X_batch, False)
         y_batch = spec_utils.crop_and_concat(mask, y_batch, False)
 
-        abs_diff = F.absolute_error(X_batch * mask, y_batch)
+        abs_diff = spec_utils.masked_l1(X_batch, mask, y_batch)
         loss = F.mean(abs_diff)
         loss.backward()
         optimizer.update()
 
-        instance_loss[local_perm] += chainer.backends.cuda.to_cpu(
-            abs_diff.data.mean(axis=(1, 2, 3)))
-        sum_loss += float(loss.data) * len(X_batch)
+        instance_loss_acc[xp.asarray(local_perm)] += \
+            abs_diff.data.mean(axis=(1, 2, 3))
+        sum_loss += loss.data * len(X_batch)
 
-    return sum_loss / len(X_train)
+    instance_loss += chainer.backends.cuda.to_cpu(instance_loss_acc)
+    return float(chainer.backends.cuda.to_cpu(sum_loss)) / len(X_train)
 
 
 def valid_inner_epoch(X_valid, y_valid, model, bs):
-    sum_loss = 0
     xp = model.xp
+    sum_loss = xp.zeros((), dtype=np.float32)
     with chainer.no_backprop_mode(), chainer.using_config('train', False):
-        for i in range(0, len(X_valid), bs):
-            X_batch = xp.asarray(X_valid[i: i + bs])
-            y_batch = xp.asarray(y_valid[i: i + bs])
-
+        for i, X_batch, y_batch in dataset.batch_generator(X_valid, y_valid, bs, xp):
             mask = model(X_batch)
             X_batch = spec_utils.crop_and_concat(mask, X_batch, False)
             y_batch = spec_utils.crop_and_concat(mask, y_batch, False)
 
-            loss = F.mean_absolute_error(X_batch * mask, y_batch)
-            sum_loss += float(loss.data) * len(X_batch)
+            loss = F.mean(spec_utils.masked_l1(X_batch, mask, y_batch))
+            sum_loss += loss.data * len(X_batch)
 
-    return sum_loss / len(X_valid)
+    return float(chainer.backends.cuda.to_cpu(sum_loss)) / len(X_valid)
 
 
 def main():
@@ -132,10 +131,49 @@ def main():
         chainer.backends.cuda.check_cuda_available()
         chainer.backends.cuda.get_device(args.gpu).use()
         model.to_gpu()
+        cupy = chainer.backends.cuda.cupy
+        cupy.cuda.set_pinned_memory_allocator(
+            cupy.cuda.PinnedMemoryPool().malloc)
+        if hasattr(cupy.cuda, 'MemoryAsyncPool'):
+            try:
+                cupy.cuda.set_allocator(cupy.cuda.MemoryAsyncPool().malloc)
+            except RuntimeError:
+                # stream-ordered allocation needs CUDA 11.2+ and driver
+                # support; the default pool is fine everywhere else
+                pass
 
     optimizer = chainer.optimizers.Adam(args.learning_rate)
     optimizer.setup(model)
 
+    if args.gpu >= 0:
+        # run the cuDNN autotune searches (and the static-graph traces) for
+        # both input signatures up front, so the algorithm benchmarking does
+        # not land inside the first timed epoch; the dummy batches must not
+        # leak into the batch-norm statistics, hence the save/restore
+        bn_links = [
+            link for link in model.links()
+            if isinstance(link, L.BatchNormalization)]
+        bn_stats = [
+            (link.avg_mean.copy(), link.avg_var.copy(), link.N)
+            for link in bn_links]
+        for warm_bs, warm_crop, train_mode in (
+                (args.batchsize, args.cropsize, True),
+                (args.val_batchsize, args.val_cropsize, False)):
+            X_dummy = model.xp.zeros(
+                (warm_bs, 2, args.hop_length, warm_crop), dtype=np.float32)
+            with chainer.using_config('train', train_mode):
+                if train_mode:
+                    model.cleargrads()
+                    F.mean(model(X_dummy)).backward()
+                    model.cleargrads()
+                else:
+                    with chainer.no_backprop_mode():
+                        model(X_dummy)
+        for link, (avg_mean, avg_var, n) in zip(bn_links, bn_stats):
+            link.avg_mean[...] = avg_mean
+            link.avg_var[...] = avg_var
+            link.N = n
+
     train_filelist, val_filelist = train_val_split(
         mix_dir=args.mixture_dataset,
         inst_dir=args.instrumental_dataset,
@@ -168,6 +206,11 @@ def main():
             perm = np.random.permutation(len(oracle_X))
             X_train[perm] = oracle_X
             y_train[perm] = oracle_y
+            # dead until get_oracle_data rebuilds them at the end of the
+            # epoch, so give the copies back before training starts
+            oracle_X = None
+            oracle_y = None
+            gc.collect()
 
         print('# epoch', epoch)
         instance_loss = np.zeros(len(X_train), dtype=np.float32)
@@ -182,7 +225,6 @@ def main():
                   .format(train_loss * 1000, valid_loss * 1000))
 
             log.append([train_loss, valid_loss])
-            np.save('log_{}.npy'.format(timestamp), np.asarray(log))
 
             best_count += 1
             if valid_loss < best_loss:
@@ -198,6 +240,8 @@ def main():
                 optimizer.alpha = max(optimizer.alpha, args.lr_min)
                 print('    * learning rate decay: {:.6f}'.format(optimizer.alpha))
 
+        np.save('log_{}.npy'.format(timestamp), np.asarray(log))
+
         if args.oracle_rate > 0:
             instance_loss /= args.inner_epoch
             oracle_X, oracle_y, idx = dataset.get_oracle_data(
@@ -206,6 +250,8 @@ def main():
 
         del X_train, y_train
         gc.collect()
+        if args.gpu >= 0:
+            chainer.backends.cuda.cupy.get_default_memory_pool().free_all_blocks()
 
 
 if __name__ == '__main__':